@@ -1,16 +1,32 @@
 import os
 import io
+import asyncio
+import logging
 import re
 import csv
+import calendar
 import sqlite3
-from contextlib import closing
+import secrets
+import tempfile
+import threading
+from contextlib import contextmanager
+from functools import lru_cache
+from operator import itemgetter
 from datetime import date, datetime, timedelta, time
+from time import monotonic
+from pathlib import Path
 from zoneinfo import ZoneInfo
 
+from openpyxl import Workbook, load_workbook
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.styles import Font, PatternFill
+from openpyxl.utils import get_column_letter
 from telegram import Update, InputFile
+from telegram.error import RetryAfter
 from telegram.ext import ApplicationBuilder, CommandHandler, MessageHandler, ContextTypes, filters
 
 # ---------- Config ----------
+logger = logging.getLogger(__name__)
 BOT_TOKEN = os.getenv("BOT_TOKEN", "")
 ADMIN_IDS = {int(x) for x in os.getenv("ADMIN_IDS", "").replace(" ", "").split(",") if x.strip().isdigit()}
 DB_PATH = os.getenv("DB_PATH", "ippt.db")  # set DB_PATH=/data/ippt.db on Railway
@@ -23,14 +39,79 @@ except Exception:
 WINDOW_DAYS = 100
 REMINDER_INTERVAL_DAYS = int(os.getenv("REMINDER_INTERVAL_DAYS", "10"))
 
+# Webhook mode: set WEBHOOK_URL (public https base URL) to receive pushed updates; unset = long polling.
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "").rstrip("/")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET") or secrets.token_urlsafe(32)
+PORT = int(os.getenv("PORT", "8443"))
+
 # ---------- DB ----------
 def db_connect():
-    conn = sqlite3.connect(DB_PATH)
+    # IMMEDIATE: the implicit BEGIN before a write takes the write lock up front, so a transaction
+    # never has to upgrade mid-way (which fails with SQLITE_BUSY instead of waiting on busy_timeout).
+    conn = sqlite3.connect(DB_PATH, check_same_thread=False, cached_statements=256, isolation_level="IMMEDIATE")
+    conn.row_factory = sqlite3.Row
+    # Per-connection tuning, applied once at open in a single script.
+    conn.executescript("""
+        PRAGMA foreign_keys = ON;
+        PRAGMA busy_timeout = 5000;         -- wait for a competing writer instead of failing
+        PRAGMA synchronous = NORMAL;        -- WAL + NORMAL: no fsync per COMMIT
+        PRAGMA wal_autocheckpoint = 10000;  -- checkpoints mostly done by wal_checkpoint_job
+        PRAGMA temp_store = MEMORY;
+        PRAGMA cache_size = -20000;         -- ~20 MB page cache
+        PRAGMA mmap_size = 268435456;
+    """)
+    if conn.execute("PRAGMA journal_mode").fetchone()[0] != "wal":  # persistent per DB file
+        conn.execute("PRAGMA journal_mode = WAL")
+    return conn
+
+def db_connect_readonly():
+    # Under WAL, readers never wait on the writer; mode=ro guarantees these never write.
+    uri = Path(DB_PATH).resolve().as_uri() + "?mode=ro"
+    conn = sqlite3.connect(uri, uri=True, check_same_thread=False, cached_statements=256)
     conn.row_factory = sqlite3.Row
-    with conn:
-        conn.execute("PRAGMA foreign_keys = ON")
+    conn.executescript("""
+        PRAGMA busy_timeout = 5000;
+        PRAGMA temp_store = MEMORY;
+        PRAGMA cache_size = -20000;
+        PRAGMA mmap_size = 268435456;
+    """)
     return conn
 
+# One long-lived writer connection shared by all handlers (keeps SQLite's page cache warm).
+_DB = None
+_DB_LOCK = threading.Lock()
+# Readers get their own connection per thread (event loop + to_thread workers), so a SELECT
+# never sees another thread's uncommitted writes or queues behind _DB_LOCK.
+_READ = threading.local()
+
+def get_db():
+    global _DB
+    if _DB is None:
+        _DB = db_connect()
+    return _DB
+
+def read_db():
+    conn = getattr(_READ, "conn", None)
+    if conn is None:
+        get_db()  # writer first: creates the file and switches it to WAL
+        conn = _READ.conn = db_connect_readonly()
+    return conn
+
+@contextmanager
+def db_write():
+    """Serialize writers on the shared connection; commits on success, rolls back on error."""
+    conn = get_db()
+    with _DB_LOCK, conn:
+        yield conn
+
+def run_batch(statements):
+    """executemany each (sql, rows) pair in one write transaction; returns their rowcounts."""
+    counts = []
+    with db_write() as conn:
+        for sql, rows in statements:
+            counts.append(conn.executemany(sql, rows).rowcount if rows else 0)
+    return counts
+
 def _ensure_column(conn, table, column):
     cur = conn.cursor()
     cur.execute(f"PRAGMA table_info({table})")
@@ -40,7 +121,9 @@ def _ensure_column(conn, table, column):
         conn.commit()
 
 def init_db():
-    with closing(db_connect()) as conn:
+    # Schema setup runs on the shared connection too, so the process only ever opens one.
+    conn = get_db()
+    with _DB_LOCK:
         cur = conn.cursor()
         cur.execute("""
             CREATE TABLE IF NOT EXISTS personnel (
@@ -91,27 +174,45 @@ def init_db():
               FOREIGN KEY (personnel_id) REFERENCES personnel(personnel_id)
             )
         """)
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_completions_tid_year ON completions(telegram_id, year)")
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_completions_tid_at ON completions(telegram_id, completed_at)")
         _ensure_column(conn, "users", "full_name")
         conn.commit()
+        # Full ANALYZE only while there are no planner stats yet; afterwards optimize refreshes them as needed.
+        has_stats = conn.execute("SELECT 1 FROM sqlite_master WHERE name='sqlite_stat1'").fetchone()
+        if not has_stats or not conn.execute("SELECT 1 FROM sqlite_stat1 LIMIT 1").fetchone():
+            conn.execute("ANALYZE")
+        conn.execute("PRAGMA optimize")
 
 # ---------- Date helpers ----------
 def format_date(d: date) -> str:
     return d.strftime("%Y-%m-%d")
 
+# Birthdays repeat across rows and runs; dates are immutable so results are safe to share.
+@lru_cache(maxsize=4096)
 def parse_date_strict(s: str) -> date:
+    # Canonical ASCII YYYY-MM-DD is sliced by hand; anything else goes through strptime (ValueError on bad input).
+    if len(s) == 10 and s.isascii() and s[4] == "-" and s[7] == "-" \
+            and s[:4].isdecimal() and s[5:7].isdecimal() and s[8:].isdecimal():
+        return date(int(s[:4]), int(s[5:7]), int(s[8:]))
     return datetime.strptime(s, "%Y-%m-%d").date()
 
+def parse_db_date(s: str) -> date:
+    # Stored dates are always written via format_date, so fixed-width slicing is safe.
+    return date(int(s[0:4]), int(s[5:7]), int(s[8:10]))
+
+@lru_cache(maxsize=4096)
 def adjusted_birthday_for_year(bday: date, year: int) -> date:
-    try:
-        return date(year, bday.month, bday.day)
-    except ValueError:
-        if bday.month == 2 and bday.day == 29:
-            return date(year, 2, 28)
-        raise
+    m, d = bday.month, bday.day
+    if m == 2 and d == 29 and not calendar.isleap(year):
+        d = 28
+    return date(year, m, d)
 
 def current_local_date() -> date:
     return datetime.now(TZINFO).date()
 
+# Pure in (birthday, date), so safe to memoize.
+@lru_cache(maxsize=4096)
 def cycle_for_date(bday: date, on: date):
     start = adjusted_birthday_for_year(bday, on.year)
     if on < start:
@@ -119,6 +220,7 @@ def cycle_for_date(bday: date, on: date):
     end_excl = adjusted_birthday_for_year(bday, start.year + 1)
     return start, end_excl
 
+@lru_cache(maxsize=4096)
 def today_in_window(bday: date, today: date):
     start = adjusted_birthday_for_year(bday, today.year)
     end = start + timedelta(days=WINDOW_DAYS)
@@ -130,6 +232,7 @@ def today_in_window(bday: date, today: date):
         return True, prev_start, prev_end
     return False, start, end
 
+@lru_cache(maxsize=4096)
 def window_for_date(bday: date, on: date):
     start = adjusted_birthday_for_year(bday, on.year)
     end = start + timedelta(days=WINDOW_DAYS)
@@ -143,6 +246,17 @@ def window_for_date(bday: date, on: date):
     next_end = next_start + timedelta(days=WINDOW_DAYS)
     return next_start, next_end
 
+_now_cache = [float("-inf"), ""]
+
+def iso_now() -> str:
+    # Second resolution is plenty for these audit timestamps; reuse the formatted string within a second.
+    m = monotonic()
+    if m - _now_cache[0] < 1.0:
+        return _now_cache[1]
+    s = datetime.now(TZINFO).isoformat()
+    _now_cache[:] = [m, s]
+    return s
+
 def iso_from_local_date(d: date, hour: int = 9, minute: int = 0) -> str:
     dt = datetime.combine(d, time(hour=hour, minute=minute, tzinfo=TZINFO))
     return dt.isoformat()
@@ -151,27 +265,28 @@ def is_admin(tid: int) -> bool:
     return tid in ADMIN_IDS
 
 # ---------- DB helpers ----------
-def get_personnel_and_user(conn: sqlite3.Connection, telegram_id: int):
-    cur = conn.cursor()
-    cur.execute("""
+# Hot-path queries kept as constants so every call hits the connection's statement cache.
+SQL_GET_USER = """
         SELECT u.telegram_id, u.personnel_id, u.verified_at, u.completed_year, u.completed_at,
-               p.birthday, p.group_name, u.full_name
+               p.birthday, p.group_name, u.full_name,
+               dc.reason AS cur_defer_reason, dc.status AS cur_defer_status,
+               dp.reason AS prev_defer_reason, dp.status AS prev_defer_status
           FROM users u
           JOIN personnel p ON u.personnel_id = p.personnel_id
-         WHERE u.telegram_id = ?
-    """, (telegram_id,))
-    r = cur.fetchone()
-    if not r:
-        return None
-    return (
-        r["telegram_id"], r["personnel_id"], r["verified_at"], r["completed_year"], r["completed_at"],
-        r["birthday"], r["group_name"], r["full_name"]
-    )
+          LEFT JOIN deferments dc ON dc.personnel_id = u.personnel_id AND dc.year = ?2
+          LEFT JOIN deferments dp ON dp.personnel_id = u.personnel_id AND dp.year = ?2 - 1
+         WHERE u.telegram_id = ?1
+"""
+SQL_GET_BIRTHDAY = "SELECT p.birthday FROM users u JOIN personnel p ON u.personnel_id = p.personnel_id WHERE u.telegram_id = ?"
 
-def get_deferment_by_pid(conn: sqlite3.Connection, personnel_id: str, year: int):
-    cur = conn.cursor()
-    cur.execute("SELECT reason, status FROM deferments WHERE personnel_id=? AND year=?", (personnel_id, year))
-    return cur.fetchone()
+def get_personnel_and_user(conn: sqlite3.Connection, telegram_id: int, year: int):
+    """User + personnel sqlite3.Row (or None), with cur_/prev_defer_* columns for the year and year-1 deferments."""
+    return conn.execute(SQL_GET_USER, (telegram_id, year)).fetchone()
+
+def get_birthday_for_user(conn: sqlite3.Connection, telegram_id: int):
+    """Birthday of the personnel linked to telegram_id, or None if not verified."""
+    r = conn.execute(SQL_GET_BIRTHDAY, (telegram_id,)).fetchone()
+    return r[0] if r else None
 
 # ---------- Commands ----------
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -210,10 +325,9 @@ async def admin_help(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def whoami(update: Update, context: ContextTypes.DEFAULT_TYPE):
     tid = update.message.from_user.id
-    with closing(db_connect()) as conn:
-        cur = conn.cursor()
-        cur.execute("SELECT personnel_id, full_name FROM users WHERE telegram_id=?", (tid,))
-        r = cur.fetchone()
+    cur = read_db().cursor()
+    cur.execute("SELECT personnel_id, full_name FROM users WHERE telegram_id=?", (tid,))
+    r = cur.fetchone()
     pid = r[0] if r and r[0] else "(not linked)"
     nm = r[1] if r and r[1] else "(no name set)"
     await update.message.reply_text(f"Telegram ID: {tid}\nLinked personnel_id: {pid}\nName: {nm}")
@@ -225,24 +339,20 @@ async def set_name(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return await msg.reply_text("Usage: /set_name <your name>\nOr: /set_name --clear")
     payload = parts[1].strip()
     if payload in ("--clear", "-c"):
-        with closing(db_connect()) as conn:
-            cur = conn.cursor()
-            cur.execute(
+        with db_write() as conn:
+            conn.execute(
                 "INSERT INTO users (telegram_id, full_name) VALUES (?, NULL) "
                 "ON CONFLICT(telegram_id) DO UPDATE SET full_name=NULL",
                 (msg.from_user.id,)
             )
-            conn.commit()
         return await msg.reply_text("Name cleared.")
     name = payload[:120]
-    with closing(db_connect()) as conn:
-        cur = conn.cursor()
-        cur.execute(
+    with db_write() as conn:
+        conn.execute(
             "INSERT INTO users (telegram_id, full_name) VALUES (?, ?) "
             "ON CONFLICT(telegram_id) DO UPDATE SET full_name=excluded.full_name",
             (msg.from_user.id, name)
         )
-        conn.commit()
     return await msg.reply_text(f"Name set to: {name}")
 
 async def verify(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -254,20 +364,19 @@ async def verify(update: Update, context: ContextTypes.DEFAULT_TYPE):
         dob = parse_date_strict(parts[2].strip())
     except Exception:
         return await update.message.reply_text("Invalid date. Use YYYY-MM-DD.")
-    with closing(db_connect()) as conn:
-        cur = conn.cursor()
-        cur.execute("SELECT birthday FROM personnel WHERE personnel_id=?", (pid,))
-        r = cur.fetchone()
-        if not r:
-            return await update.message.reply_text("No such PERSONNEL_ID. Ask admin to add you.")
-        if r[0] != format_date(dob):
-            return await update.message.reply_text("Birthday does not match our records.")
-        cur.execute(
+    cur = read_db().cursor()
+    cur.execute("SELECT birthday FROM personnel WHERE personnel_id=?", (pid,))
+    r = cur.fetchone()
+    if not r:
+        return await update.message.reply_text("No such PERSONNEL_ID. Ask admin to add you.")
+    if r[0] != format_date(dob):
+        return await update.message.reply_text("Birthday does not match our records.")
+    with db_write() as conn:
+        conn.execute(
             "INSERT INTO users (telegram_id, personnel_id, verified_at) VALUES (?, ?, ?) "
             "ON CONFLICT(telegram_id) DO UPDATE SET personnel_id=excluded.personnel_id, verified_at=excluded.verified_at",
-            (update.message.from_user.id, pid, datetime.now(TZINFO).isoformat())
+            (update.message.from_user.id, pid, iso_now())
         )
-        conn.commit()
     await update.message.reply_text("Verified and linked. Use /status.")
 
 async def add_personnel(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -282,10 +391,8 @@ async def add_personnel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     except Exception:
         return await update.message.reply_text("Invalid date. Use YYYY-MM-DD.")
     group = " ".join(parts[3:]).strip() if len(parts) > 3 else None
-    with closing(db_connect()) as conn:
-        cur = conn.cursor()
-        cur.execute("INSERT OR REPLACE INTO personnel (personnel_id, birthday, group_name) VALUES (?, ?, ?)", (pid, format_date(dob), group))
-        conn.commit()
+    with db_write() as conn:
+        conn.execute("INSERT OR REPLACE INTO personnel (personnel_id, birthday, group_name) VALUES (?, ?, ?)", (pid, format_date(dob), group))
     await update.message.reply_text(f"Added/updated {pid}.")
 
 async def update_birthday(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -299,15 +406,17 @@ async def update_birthday(update: Update, context: ContextTypes.DEFAULT_TYPE):
         dob = parse_date_strict(parts[2].strip())
     except Exception:
         return await update.message.reply_text("Invalid date. Use YYYY-MM-DD.")
-    with closing(db_connect()) as conn:
-        cur = conn.cursor()
-        cur.execute("UPDATE personnel SET birthday=? WHERE personnel_id=?", (format_date(dob), pid))
-        if cur.rowcount == 0:
-            return await update.message.reply_text("No such PERSONNEL_ID.")
-        conn.commit()
+    with db_write() as conn:
+        cur = conn.execute("UPDATE personnel SET birthday=? WHERE personnel_id=?", (format_date(dob), pid))
+        changed = cur.rowcount
+    if changed == 0:
+        return await update.message.reply_text("No such PERSONNEL_ID.")
     await update.message.reply_text(f"Updated {pid} birthday to {format_date(dob)}.")
 
 # ---------- Import CSV/XLSX ----------
+# Zero-width spaces and stray BOMs pasted from spreadsheets.
+_ZW_TABLE = str.maketrans("", "", "\u200b\ufeff")
+
 async def import_csv_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not is_admin(update.message.from_user.id):
         return await update.message.reply_text("Admins only.")
@@ -324,37 +433,58 @@ async def document_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not (lower.endswith(".csv") or lower.endswith(".xlsx")):
         return await update.message.reply_text("Unsupported file type. Please upload .csv or .xlsx.")
     file = await doc.get_file()
-    tmp_path = os.path.join("/tmp", doc.file_unique_id + ("_xlsx" if lower.endswith(".xlsx") else "_csv"))
+    tmp_path = os.path.join("/tmp", doc.file_unique_id + (".xlsx" if lower.endswith(".xlsx") else ".csv"))
     await file.download_to_drive(tmp_path)
 
-    count = 0
+    # Parsing is CPU-bound on large sheets, so it runs on a worker thread like the upsert.
     if lower.endswith(".csv"):
-        with open(tmp_path, "rb") as f:
-            data = f.read()
-        if data.startswith(b"\xef\xbb\xbf"):
-            data = data[3:]
-        import io as _io
-        reader = csv.DictReader(_io.StringIO(data.decode("utf-8", errors="replace")))
+        records = await asyncio.to_thread(_read_csv_records, tmp_path)
+    else:
+        records = await asyncio.to_thread(_read_xlsx_records, tmp_path)
+        if records is None:
+            return await update.message.reply_text("XLSX must include 'personnel_id' and 'birthday' headers.")
+
+    if records:
+        await asyncio.to_thread(_upsert_personnel, records)
+
+    context.user_data["awaiting_import"] = False
+    await update.message.reply_text(f"Imported {len(records)} row(s).")
+
+def _read_csv_records(path):
+    """(personnel_id, birthday, group) tuples from an uploaded CSV; rows without a valid date are skipped."""
+    records = []
+    # Columns are looked up by header position.
+    with open(path, "r", encoding="utf-8-sig", errors="replace", newline="") as f:
+        reader = csv.reader(f)
+        cols = {h.translate(_ZW_TABLE): i for i, h in enumerate(next(reader, []))}
+        def col(row, *names):
+            for name in names:
+                i = cols.get(name)
+                if i is not None and i < len(row) and row[i]:
+                    return row[i]
+            return ""
         for row in reader:
-            pid = (row.get("personnel_id") or row.get("id") or "").strip()
-            bday = (row.get("birthday") or row.get("dob") or "").strip()
-            group = (row.get("group") or row.get("group_name") or "").strip() or None
+            pid = col(row, "personnel_id", "id").strip()
+            bday = col(row, "birthday", "dob").translate(_ZW_TABLE).strip()
+            group = col(row, "group", "group_name").strip() or None
             if not pid or not bday:
                 continue
             try:
                 dob = parse_date_strict(bday)
             except Exception:
                 continue
-            with closing(db_connect()) as conn:
-                cur = conn.cursor()
-                cur.execute("INSERT OR REPLACE INTO personnel (personnel_id, birthday, group_name) VALUES (?, ?, ?)", (pid, format_date(dob), group))
-                conn.commit()
-                count += 1
-    else:
-        from openpyxl import load_workbook
-        wb = load_workbook(tmp_path)
-        ws = wb.active
-        headers = [str(c.value).strip().lower() if c.value is not None else "" for c in next(ws.iter_rows(min_row=1, max_row=1))]
+            records.append((pid, format_date(dob), group))
+    return records
+
+def _read_xlsx_records(path):
+    """Same as _read_csv_records for the active XLSX sheet, or None if the required headers are missing."""
+    records = []
+    # read_only + one lazy row iterator, so rows are streamed from the file.
+    wb = load_workbook(path, read_only=True, data_only=True)
+    try:
+        row_iter = wb.active.iter_rows(values_only=True)
+        first = next(row_iter, None) or ()
+        headers = [str(v).translate(_ZW_TABLE).strip().lower() if v is not None else "" for v in first]
         def get_col(names):
             for i, h in enumerate(headers):
                 if h in names:
@@ -364,28 +494,42 @@ async def document_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         bday_col = get_col({"birthday", "dob"})
         group_col = get_col({"group", "group_name"})
         if pid_col is None or bday_col is None:
-            return await update.message.reply_text("XLSX must include 'personnel_id' and 'birthday' headers.")
-        for row in ws.iter_rows(min_row=2):
-            pid = str(row[pid_col].value).strip() if row[pid_col].value is not None else ""
-            bday_cell = row[bday_col].value
-            group = (str(row[group_col].value).strip() if (group_col is not None and row[group_col].value is not None) else None)
+            return None
+        def value(row, i):
+            return row[i] if i is not None and i < len(row) else None
+        for row in row_iter:
+            pid_cell = value(row, pid_col)
+            pid = str(pid_cell).strip() if pid_cell is not None else ""
+            bday_cell = value(row, bday_col)
+            group_cell = value(row, group_col)
+            group = str(group_cell).strip() if group_cell is not None else None
             if not pid or not bday_cell:
                 continue
             try:
-                if isinstance(bday_cell, datetime):
+                # Text and Excel date cells cover nearly every sheet, so test for them first.
+                if isinstance(bday_cell, str):
+                    dob = parse_date_strict(bday_cell.translate(_ZW_TABLE).strip())
+                elif isinstance(bday_cell, datetime):
                     dob = bday_cell.date()
+                elif isinstance(bday_cell, date):
+                    dob = bday_cell
                 else:
                     dob = parse_date_strict(str(bday_cell).strip())
             except Exception:
                 continue
-            with closing(db_connect()) as conn:
-                cur = conn.cursor()
-                cur.execute("INSERT OR REPLACE INTO personnel (personnel_id, birthday, group_name) VALUES (?, ?, ?)", (pid, format_date(dob), group))
-                conn.commit()
-                count += 1
-
-    context.user_data["awaiting_import"] = False
-    await update.message.reply_text(f"Imported {count} row(s).")
+            records.append((pid, format_date(dob), group))
+    finally:
+        wb.close()
+    return records
+
+def _upsert_personnel(records):
+    # One transaction and one prepared statement for the whole file.
+    with db_write() as conn:
+        conn.executemany(
+            "INSERT INTO personnel (personnel_id, birthday, group_name) VALUES (?, ?, ?) "
+            "ON CONFLICT(personnel_id) DO UPDATE SET birthday=excluded.birthday, group_name=excluded.group_name",
+            records,
+        )
 
 # ---------- Status ----------
 async def status(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -393,44 +537,46 @@ async def status(update: Update, context: ContextTypes.DEFAULT_TYPE):
     today = current_local_date()
     tid = msg.from_user.id
 
-    with closing(db_connect()) as conn:
-        data = get_personnel_and_user(conn, tid)
-    if not data:
+    conn = read_db()
+    row = get_personnel_and_user(conn, tid, today.year)
+    if not row:
         return await msg.reply_text("Please /verify first.")
 
-    _, personnel_id, _, completed_year, _, birthday_str, group_name, full_name = data
-    bday = parse_date_strict(birthday_str)
+    personnel_id = row["personnel_id"]
+    completed_year = row["completed_year"]
+    group_name = row["group_name"]
+    full_name = row["full_name"]
+    bday = parse_db_date(row["birthday"])
 
     in_window, start, end = today_in_window(bday, today)
     window_key = start.year
     next_start = adjusted_birthday_for_year(bday, start.year + 1)
 
-    with closing(db_connect()) as conn:
-        d = get_deferment_by_pid(conn, personnel_id, window_key)
-    defer_reason, defer_status = (d[0], d[1]) if d else (None, None)
+    if window_key == today.year:
+        defer_reason, defer_status = row["cur_defer_reason"], row["cur_defer_status"]
+    else:
+        defer_reason, defer_status = row["prev_defer_reason"], row["prev_defer_status"]
 
     cycle_start = start
     cycle_end_excl = adjusted_birthday_for_year(bday, start.year + 1)
     window_end = end
 
-    with closing(db_connect()) as conn:
-        cur = conn.cursor()
-        cur.execute(
-            "SELECT completed_at FROM completions WHERE telegram_id=? AND completed_at >= ? AND completed_at <= ? ORDER BY completed_at DESC LIMIT 1",
-            (tid, iso_from_local_date(cycle_start, 0, 0), iso_from_local_date(window_end, 23, 59)),
-        )
-        row_win = cur.fetchone()
+    cur = conn.cursor()
+    cur.execute(
+        "SELECT completed_at FROM completions WHERE telegram_id=? AND completed_at >= ? AND completed_at <= ? ORDER BY completed_at DESC LIMIT 1",
+        (tid, iso_from_local_date(cycle_start, 0, 0), iso_from_local_date(window_end, 23, 59)),
+    )
+    row_win = cur.fetchone()
     completed_in_window_date = datetime.fromisoformat(row_win[0]).date() if row_win else None
 
     completed_in_cycle_date = None
     if not completed_in_window_date:
-        with closing(db_connect()) as conn:
-            cur = conn.cursor()
-            cur.execute(
-                "SELECT completed_at FROM completions WHERE telegram_id=? AND completed_at >= ? AND completed_at < ? ORDER BY completed_at DESC LIMIT 1",
-                (tid, iso_from_local_date(cycle_start, 0, 0), iso_from_local_date(cycle_end_excl - timedelta(days=1), 23, 59)),
-            )
-            row_cyc = cur.fetchone()
+        cur = conn.cursor()
+        cur.execute(
+            "SELECT completed_at FROM completions WHERE telegram_id=? AND completed_at >= ? AND completed_at < ? ORDER BY completed_at DESC LIMIT 1",
+            (tid, iso_from_local_date(cycle_start, 0, 0), iso_from_local_date(cycle_end_excl - timedelta(days=1), 23, 59)),
+        )
+        row_cyc = cur.fetchone()
         completed_in_cycle_date = datetime.fromisoformat(row_cyc[0]).date() if row_cyc else None
 
     if completed_in_window_date:
@@ -456,13 +602,12 @@ async def status(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     cycle_today_start, cycle_today_end_excl = cycle_for_date(bday, today)
     cycle_window_end_today = cycle_today_start + timedelta(days=WINDOW_DAYS)
-    with closing(db_connect()) as conn:
-        cur = conn.cursor()
-        cur.execute(
-            "SELECT completed_at FROM completions WHERE telegram_id=? AND completed_at >= ? AND completed_at < ? ORDER BY completed_at DESC LIMIT 1",
-            (tid, iso_from_local_date(cycle_today_start, 0, 0), iso_from_local_date(cycle_today_end_excl - timedelta(days=1), 23, 59)),
-        )
-        r = cur.fetchone()
+    cur = conn.cursor()
+    cur.execute(
+        "SELECT completed_at FROM completions WHERE telegram_id=? AND completed_at >= ? AND completed_at < ? ORDER BY completed_at DESC LIMIT 1",
+        (tid, iso_from_local_date(cycle_today_start, 0, 0), iso_from_local_date(cycle_today_end_excl - timedelta(days=1), 23, 59)),
+    )
+    r = cur.fetchone()
     if r:
         cd = datetime.fromisoformat(r[0]).date()
         if cd <= cycle_window_end_today:
@@ -498,13 +643,11 @@ async def complete(update: Update, context: ContextTypes.DEFAULT_TYPE):
         except Exception:
             return await msg.reply_text("Invalid date. Use YYYY-MM-DD, e.g., /complete 2025-01-10")
 
-    with closing(db_connect()) as conn:
-        data = get_personnel_and_user(conn, msg.from_user.id)
-    if not data or not data[1]:
+    birthday_str = get_birthday_for_user(read_db(), msg.from_user.id)
+    if not birthday_str:
         return await msg.reply_text("You're not verified yet. Use /verify first.")
 
-    _, _, _, _, _, birthday_str, _, _ = data
-    bday = parse_date_strict(birthday_str)
+    bday = parse_db_date(birthday_str)
     in_window, start, end = today_in_window(bday, today)
     if not in_window:
         return await msg.reply_text(f"You're outside your current window. Window: {format_date(start)} → {format_date(end)}")
@@ -515,12 +658,11 @@ async def complete(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     window_key = start.year
     now_iso = iso_from_local_date(completion_date, hour=9, minute=0)
-    with closing(db_connect()) as conn:
+    with db_write() as conn:
         cur = conn.cursor()
         cur.execute("UPDATE users SET completed_year=?, completed_at=? WHERE telegram_id=?", (window_key, now_iso, msg.from_user.id))
         cur.execute("DELETE FROM completions WHERE telegram_id=? AND year=?", (msg.from_user.id, window_key))
         cur.execute("INSERT INTO completions (telegram_id, year, completed_at) VALUES (?, ?, ?)", (msg.from_user.id, window_key, now_iso))
-        conn.commit()
 
     await msg.reply_text(
         f"Recorded as completed for the {WINDOW_DAYS}-day window starting {format_date(start)}.\n"
@@ -532,13 +674,11 @@ async def uncomplete(update: Update, context: ContextTypes.DEFAULT_TYPE):
     tid = msg.from_user.id
     today = current_local_date()
 
-    with closing(db_connect()) as conn:
-        data = get_personnel_and_user(conn, tid)
-    if not data or not data[1]:
+    birthday_str = get_birthday_for_user(read_db(), tid)
+    if not birthday_str:
         return await msg.reply_text("You're not verified yet. Use /verify first.")
 
-    _, _, _, _, _, birthday_str, _, _ = data
-    bday = parse_date_strict(birthday_str)
+    bday = parse_db_date(birthday_str)
 
     in_window, start, end = today_in_window(bday, today)
     if not in_window:
@@ -550,7 +690,7 @@ async def uncomplete(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     window_key = start.year
 
-    with closing(db_connect()) as conn:
+    with db_write() as conn:
         cur = conn.cursor()
         cur.execute(
             "UPDATE users SET completed_year=NULL, completed_at=NULL WHERE telegram_id=? AND completed_year=?",
@@ -558,7 +698,6 @@ async def uncomplete(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         changed = cur.rowcount
         cur.execute("DELETE FROM completions WHERE telegram_id=? AND year=?", (tid, window_key))
-        conn.commit()
 
     if changed:
         await msg.reply_text("Completion cleared for this window.")
@@ -566,41 +705,84 @@ async def uncomplete(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await msg.reply_text("There’s no recorded completion for this active window to clear.")
 
 # ---------- Admin helpers ----------
-async def _resolve_tokens_to_tids(tokens):
+_TOKEN_SPLIT_RE = re.compile(r"[,\s]+")
+_DATE_RE = re.compile(r"\d{4}-\d{2}-\d{2}")
+_DATE_FLAG_RE = re.compile(r"--date\s+(\d{4}-\d{2}-\d{2})")
+
+def _placeholders(values):
+    return ",".join("?" * len(values))
+
+async def _resolve_tokens_to_tids(tokens, conn=None):
+    # Pure Telegram-ID input never touches the database.
     tids = set()
-    with closing(db_connect()) as conn:
-        cur = conn.cursor()
-        for t in tokens:
-            t = t.strip()
-            if not t:
-                continue
-            if t.isdigit():
-                tids.add(int(t)); continue
-            cur.execute("SELECT telegram_id FROM users WHERE personnel_id=?", (t,))
-            for r in cur.fetchall():
-                if r[0] is not None:
-                    tids.add(int(r[0]))
+    pid_tokens = []
+    for t in tokens:
+        t = t.strip()
+        if not t:
+            continue
+        if t.isdigit():
+            tids.add(int(t))
+        else:
+            pid_tokens.append(t)
+    if pid_tokens:
+        pid_tokens = list(dict.fromkeys(pid_tokens))
+        cur = (conn or read_db()).execute(
+            f"SELECT telegram_id FROM users WHERE personnel_id IN ({_placeholders(pid_tokens)})", pid_tokens
+        )
+        tids.update(int(r[0]) for r in cur.fetchall() if r[0] is not None)
     return tids
 
-async def _resolve_tokens_to_pids(tokens):
-    pids = set()
-    with closing(db_connect()) as conn:
-        cur = conn.cursor()
-        for t in tokens:
-            t = t.strip()
-            if not t:
-                continue
-            cur.execute("SELECT 1 FROM personnel WHERE personnel_id=?", (t,))
-            if cur.fetchone():
-                pids.add(t); continue
-            if t.isdigit():
-                cur.execute("SELECT personnel_id FROM users WHERE telegram_id=?", (int(t),))
-                r = cur.fetchone()
-                if r and r[0]:
-                    pids.add(r[0])
+async def _resolve_tokens_to_pids(tokens, conn=None):
+    toks = list(dict.fromkeys(t.strip() for t in tokens if t.strip()))
+    if not toks:
+        return set()
+    conn = conn or read_db()
+    cur = conn.execute(f"SELECT personnel_id FROM personnel WHERE personnel_id IN ({_placeholders(toks)})", toks)
+    pids = {r[0] for r in cur.fetchall()}
+    # Numeric tokens that are not personnel IDs are treated as Telegram IDs.
+    tids = [int(t) for t in toks if t not in pids and t.isdigit()]
+    if tids:
+        cur = conn.execute(f"SELECT personnel_id FROM users WHERE telegram_id IN ({_placeholders(tids)})", tids)
+        pids.update(r[0] for r in cur.fetchall() if r[0])
     return pids
 
+def _parse_reason_args(raw):
+    """(tokens, year, reason) from "/cmd <tokens> [YEAR] -- <reason>", or None without tokens before " -- "."""
+    sep = raw.find(" -- ")
+    if sep < 0:
+        return None
+    # The command word is the first token.
+    tokens = [t for t in _TOKEN_SPLIT_RE.split(raw[:sep]) if t][1:]
+    if not tokens:
+        return None
+    year = None
+    if len(tokens[-1]) == 4 and tokens[-1].isdecimal():
+        year = int(tokens[-1]); tokens = tokens[:-1]
+    return tokens, year, raw[sep + 4:].strip()
+
 # ---------- Admin: complete / uncomplete ----------
+def _tid_birthdays(tids, conn=None):
+    """{telegram_id: birthday date} for the verified users among tids, in one query."""
+    tids = list(tids)
+    if not tids:
+        return {}
+    cur = (conn or read_db()).execute(
+        "SELECT u.telegram_id, p.birthday FROM users u JOIN personnel p ON u.personnel_id=p.personnel_id "
+        f"WHERE u.telegram_id IN ({_placeholders(tids)})", tids
+    )
+    return {tid: parse_db_date(bday) for tid, bday in cur.fetchall()}
+
+def _pid_years(pids, year, period_for_date):
+    """(personnel_id, year) pairs: the given YEAR, else the year the current window/cycle started."""
+    if year is not None:
+        return [(pid, year) for pid in pids]
+    if not pids:
+        return []
+    pids = list(pids)
+    today = current_local_date()
+    cur = read_db().execute(f"SELECT personnel_id, birthday FROM personnel WHERE personnel_id IN ({_placeholders(pids)})", pids)
+    return [(pid, period_for_date(parse_db_date(bday), today)[0].year) for pid, bday in cur.fetchall()]
+
 async def admin_complete(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not is_admin(update.message.from_user.id):
         return await update.message.reply_text("Admins only.")
@@ -612,7 +794,7 @@ async def admin_complete(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
 
     tail = parts[1].strip()
-    m = re.search(r"--date\s+(\d{4}-\d{2}-\d{2})", tail)
+    m = _DATE_FLAG_RE.search(tail)
     date_override = None
     if m:
         try:
@@ -621,10 +803,10 @@ async def admin_complete(update: Update, context: ContextTypes.DEFAULT_TYPE):
             return await update.message.reply_text("Invalid --date. Use YYYY-MM-DD.")
         tail = (tail[:m.start()] + tail[m.end():]).strip()
 
-    tokens = [t for t in re.split(r"[,\\s]+", tail) if t]
+    tokens = [t for t in _TOKEN_SPLIT_RE.split(tail) if t]
 
     if date_override is None:
-        date_idx = next((i for i, t in enumerate(tokens) if re.fullmatch(r"\\d{4}-\\d{2}-\\d{2}", t)), None)
+        date_idx = next((i for i, t in enumerate(tokens) if len(t) == 10 and _DATE_RE.fullmatch(t)), None)
         if date_idx is not None:
             try:
                 date_override = parse_date_strict(tokens[date_idx])
@@ -633,7 +815,7 @@ async def admin_complete(update: Update, context: ContextTypes.DEFAULT_TYPE):
             tokens.pop(date_idx)
 
     year = None
-    if date_override is None and tokens and re.fullmatch(r"\\d{4}", tokens[-1] or ""):
+    if date_override is None and tokens and len(tokens[-1]) == 4 and tokens[-1].isdecimal():
         year = int(tokens[-1])
         tokens = tokens[:-1]
 
@@ -644,49 +826,35 @@ async def admin_complete(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not tids:
         return await update.message.reply_text("No verified users matched these tokens.")
 
-    updated = 0
-    replaced = 0
-    with closing(db_connect()) as conn:
-        cur = conn.cursor()
-        for tid in tids:
-            cur.execute(
-                "SELECT p.birthday FROM users u JOIN personnel p ON u.personnel_id=p.personnel_id WHERE u.telegram_id=?",
-                (tid,),
-            )
-            r = cur.fetchone()
-            if not r:
-                continue
-            bday = parse_date_strict(r[0])
-
-            if date_override is not None:
-                cstart, cend_excl = cycle_for_date(bday, date_override)
-                if not (cstart <= date_override < cend_excl):
-                    return await update.message.reply_text(
-                        f"Date {format_date(date_override)} is not inside the birthday cycle for at least one user."
-                    )
-                target_year = cstart.year
-                completion_iso = iso_from_local_date(date_override, hour=9, minute=0)
+    # Birthdays come in one query and targets are computed before taking the write lock.
+    today = current_local_date()
+    rows = []
+    for tid, bday in _tid_birthdays(tids).items():
+        if date_override is not None:
+            cstart, cend_excl = cycle_for_date(bday, date_override)
+            if not (cstart <= date_override < cend_excl):
+                return await update.message.reply_text(
+                    f"Date {format_date(date_override)} is not inside the birthday cycle for at least one user."
+                )
+            target_year = cstart.year
+            completion_iso = iso_from_local_date(date_override, hour=9, minute=0)
+        else:
+            if year is None:
+                _, start, _ = today_in_window(bday, today)
             else:
-                if year is None:
-                    _, start, _ = today_in_window(bday, current_local_date())
-                    target_year = start.year
-                else:
-                    start = adjusted_birthday_for_year(bday, year)
-                    target_year = start.year
-                completion_iso = datetime.now(TZINFO).isoformat()
-
-            cur.execute(
-                "UPDATE users SET completed_year=?, completed_at=? WHERE telegram_id=?",
-                (target_year, completion_iso, tid),
-            )
-            updated += cur.rowcount
-            cur.execute("DELETE FROM completions WHERE telegram_id=? AND year=?", (tid, target_year))
-            cur.execute(
-                "INSERT INTO completions (telegram_id, year, completed_at) VALUES (?, ?, ?)",
-                (tid, target_year, completion_iso),
-            )
-            replaced += 1
-        conn.commit()
+                start = adjusted_birthday_for_year(bday, year)
+            target_year = start.year
+            completion_iso = iso_now()
+        rows.append((tid, target_year, completion_iso))
+
+    updated, _, _ = await asyncio.to_thread(run_batch, [
+        ("UPDATE users SET completed_year=?, completed_at=? WHERE telegram_id=?",
+         [(target_year, completion_iso, tid) for tid, target_year, completion_iso in rows]),
+        ("DELETE FROM completions WHERE telegram_id=? AND year=?",
+         [(tid, target_year) for tid, target_year, _ in rows]),
+        ("INSERT INTO completions (telegram_id, year, completed_at) VALUES (?, ?, ?)", rows),
+    ])
+    replaced = len(rows)
 
     note = " (date took precedence over YEAR)" if date_override is not None else ""
     return await update.message.reply_text(
@@ -700,32 +868,24 @@ async def admin_uncomplete(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if len(parts) < 2:
         return await update.message.reply_text("Usage: /admin_uncomplete <tokens> [YEAR]")
     tail = parts[1].strip()
-    tokens = [t for t in re.split(r"[,\\s]+", tail) if t]
+    tokens = [t for t in _TOKEN_SPLIT_RE.split(tail) if t]
     year = None
-    if tokens and re.fullmatch(r"\\d{4}", tokens[-1] or ""):
+    if tokens and len(tokens[-1]) == 4 and tokens[-1].isdecimal():
         year = int(tokens[-1]); tokens = tokens[:-1]
     if not tokens:
         return await update.message.reply_text("No IDs provided.")
 
     tids = await _resolve_tokens_to_tids(tokens)
-    cleared = 0
-    with closing(db_connect()) as conn:
-        cur = conn.cursor()
-        for tid in tids:
-            if year is None:
-                cur.execute("SELECT p.birthday FROM users u JOIN personnel p ON u.personnel_id=p.personnel_id WHERE u.telegram_id=?", (tid,))
-                r = cur.fetchone()
-                if not r:
-                    continue
-                bday = parse_date_strict(r[0])
-                _, start, _ = today_in_window(bday, current_local_date())
-                target_year = start.year
-            else:
-                target_year = year
-            cur.execute("UPDATE users SET completed_year=NULL, completed_at=NULL WHERE telegram_id=? AND completed_year=?", (tid, target_year))
-            cur.execute("DELETE FROM completions WHERE telegram_id=? AND year=?", (tid, target_year))
-            cleared += cur.rowcount
-        conn.commit()
+    if year is None:
+        today = current_local_date()
+        pairs = [(tid, today_in_window(bday, today)[1].year) for tid, bday in _tid_birthdays(tids).items()]
+    else:
+        pairs = [(tid, year) for tid in tids]
+
+    _, cleared = await asyncio.to_thread(run_batch, [
+        ("UPDATE users SET completed_year=NULL, completed_at=NULL WHERE telegram_id=? AND completed_year=?", pairs),
+        ("DELETE FROM completions WHERE telegram_id=? AND year=?", pairs),
+    ])
 
     return await update.message.reply_text(f"Cleared completion for {cleared} user(s).")
 
@@ -733,41 +893,21 @@ async def admin_uncomplete(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def defer_reason(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not is_admin(update.message.from_user.id):
         return await update.message.reply_text("Admins only.")
-    raw = update.message.text
-    if " -- " not in raw:
+    parsed = _parse_reason_args(update.message.text)
+    if parsed is None:
         return await update.message.reply_text("Usage: /defer_reason <tokens> [YEAR] -- <reason>")
-    head, reason = raw.split(" -- ", 1)
-    parts = head.split(maxsplit=1)
-    if len(parts) < 2:
-        return await update.message.reply_text("Usage: /defer_reason <tokens> [YEAR] -- <reason>")
-    tail = parts[1].strip()
-    tokens = [t for t in re.split(r"[,\\s]+", tail) if t]
-    year = None
-    if tokens and re.fullmatch(r"\\d{4}", tokens[-1] or ""):
-        year = int(tokens[-1]); tokens = tokens[:-1]
+    tokens, year, reason = parsed
     if not tokens:
         return await update.message.reply_text("No IDs provided.")
 
     pids = await _resolve_tokens_to_pids(tokens)
-    now = datetime.now(TZINFO).isoformat()
-    with closing(db_connect()) as conn:
-        cur = conn.cursor()
-        for pid in pids:
-            win_year = year
-            if win_year is None:
-                cur.execute("SELECT birthday FROM personnel WHERE personnel_id=?", (pid,))
-                r = cur.fetchone()
-                if not r:
-                    continue
-                bday = parse_date_strict(r[0])
-                start, _ = window_for_date(bday, current_local_date())
-                win_year = start.year
-            cur.execute(
-                "INSERT INTO deferments (personnel_id, year, reason, status, created_at) VALUES (?, ?, ?, 'approved', ?) "
-                "ON CONFLICT(personnel_id, year) DO UPDATE SET reason=excluded.reason, status='approved'",
-                (pid, win_year, reason.strip(), now),
-            )
-        conn.commit()
+    now = iso_now()
+    rows = [(pid, win_year, reason, now) for pid, win_year in _pid_years(pids, year, window_for_date)]
+    await asyncio.to_thread(run_batch, [(
+        "INSERT INTO deferments (personnel_id, year, reason, status, created_at) VALUES (?, ?, ?, 'approved', ?) "
+        "ON CONFLICT(personnel_id, year) DO UPDATE SET reason=excluded.reason, status='approved'",
+        rows,
+    )])
     await update.message.reply_text(f"Reason set for {len(pids)} user(s).")
 
 async def defer_reset(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -777,68 +917,36 @@ async def defer_reset(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if len(parts) < 2:
         return await update.message.reply_text("Usage: /defer_reset <tokens> [YEAR]")
     tail = parts[1].strip()
-    tokens = [t for t in re.split(r"[,\\s]+", tail) if t]
+    tokens = [t for t in _TOKEN_SPLIT_RE.split(tail) if t]
     year = None
-    if tokens and re.fullmatch(r"\\d{4}", tokens[-1] or ""):
+    if tokens and len(tokens[-1]) == 4 and tokens[-1].isdecimal():
         year = int(tokens[-1]); tokens = tokens[:-1]
     if not tokens:
         return await update.message.reply_text("No IDs provided.")
 
     pids = await _resolve_tokens_to_pids(tokens)
-    deleted = 0
-    with closing(db_connect()) as conn:
-        cur = conn.cursor()
-        for pid in pids:
-            win_year = year
-            if win_year is None:
-                cur.execute("SELECT birthday FROM personnel WHERE personnel_id=?", (pid,))
-                r = cur.fetchone()
-                if not r: continue
-                bday = parse_date_strict(r[0])
-                start, _ = window_for_date(bday, current_local_date())
-                win_year = start.year
-            cur.execute("DELETE FROM deferments WHERE personnel_id=? AND year=?", (pid, win_year))
-            deleted += cur.rowcount
-        conn.commit()
+    pairs = _pid_years(pids, year, window_for_date)
+    deleted, = await asyncio.to_thread(run_batch, [("DELETE FROM deferments WHERE personnel_id=? AND year=?", pairs)])
     return await update.message.reply_text(f"Deferments cleared: {deleted} row(s).")
 
 async def cycle_reason(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not is_admin(update.message.from_user.id):
         return await update.message.reply_text("Admins only.")
-    raw = update.message.text
-    if " -- " not in raw:
-        return await update.message.reply_text("Usage: /cycle_reason <tokens> [YEAR] -- <reason>")
-    head, reason = raw.split(" -- ", 1)
-    parts = head.split(maxsplit=1)
-    if len(parts) < 2:
+    parsed = _parse_reason_args(update.message.text)
+    if parsed is None:
         return await update.message.reply_text("Usage: /cycle_reason <tokens> [YEAR] -- <reason>")
-    tail = parts[1].strip()
-    tokens = [t for t in re.split(r"[,\\s]+", tail) if t]
-    year = None
-    if tokens and re.fullmatch(r"\\d{4}", tokens[-1] or ""):
-        year = int(tokens[-1]); tokens = tokens[:-1]
+    tokens, year, reason = parsed
     if not tokens:
         return await update.message.reply_text("No IDs provided.")
 
     pids = await _resolve_tokens_to_pids(tokens)
-    now = datetime.now(TZINFO).isoformat()
-    with closing(db_connect()) as conn:
-        cur = conn.cursor()
-        for pid in pids:
-            cyc_year = year
-            if cyc_year is None:
-                cur.execute("SELECT birthday FROM personnel WHERE personnel_id=?", (pid,))
-                r = cur.fetchone()
-                if not r: continue
-                bday = parse_date_strict(r[0])
-                start, _ = cycle_for_date(bday, current_local_date())
-                cyc_year = start.year
-            cur.execute(
-                "INSERT INTO cycle_notes (personnel_id, year, reason, created_at) VALUES (?, ?, ?, ?) "
-                "ON CONFLICT(personnel_id, year) DO UPDATE SET reason=excluded.reason",
-                (pid, cyc_year, reason.strip(), now),
-            )
-        conn.commit()
+    now = iso_now()
+    rows = [(pid, cyc_year, reason, now) for pid, cyc_year in _pid_years(pids, year, cycle_for_date)]
+    await asyncio.to_thread(run_batch, [(
+        "INSERT INTO cycle_notes (personnel_id, year, reason, created_at) VALUES (?, ?, ?, ?) "
+        "ON CONFLICT(personnel_id, year) DO UPDATE SET reason=excluded.reason",
+        rows,
+    )])
     await update.message.reply_text(f"Cycle reason recorded for {len(pids)} user(s).")
 
 async def cycle_reason_clear(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -848,29 +956,16 @@ async def cycle_reason_clear(update: Update, context: ContextTypes.DEFAULT_TYPE)
     if len(parts) < 2:
         return await update.message.reply_text("Usage: /cycle_reason_clear <tokens> [YEAR]")
     tail = parts[1].strip()
-    tokens = [t for t in re.split(r"[,\\s]+", tail) if t]
+    tokens = [t for t in _TOKEN_SPLIT_RE.split(tail) if t]
     year = None
-    if tokens and re.fullmatch(r"\\d{4}", tokens[-1] or ""):
+    if tokens and len(tokens[-1]) == 4 and tokens[-1].isdecimal():
         year = int(tokens[-1]); tokens = tokens[:-1]
     if not tokens:
         return await update.message.reply_text("No IDs provided.")
 
     pids = await _resolve_tokens_to_pids(tokens)
-    deleted = 0
-    with closing(db_connect()) as conn:
-        cur = conn.cursor()
-        for pid in pids:
-            cyc_year = year
-            if cyc_year is None:
-                cur.execute("SELECT birthday FROM personnel WHERE personnel_id=?", (pid,))
-                r = cur.fetchone()
-                if not r: continue
-                bday = parse_date_strict(r[0])
-                start, _ = cycle_for_date(bday, current_local_date())
-                cyc_year = start.year
-            cur.execute("DELETE FROM cycle_notes WHERE personnel_id=? AND year=?", (pid, cyc_year))
-            deleted += cur.rowcount
-        conn.commit()
+    pairs = _pid_years(pids, year, cycle_for_date)
+    deleted, = await asyncio.to_thread(run_batch, [("DELETE FROM cycle_notes WHERE personnel_id=? AND year=?", pairs)])
     return await update.message.reply_text(f"Cycle reasons cleared: {deleted} row(s).")
 
 # ---------- Admin: unlink & remove ----------
@@ -880,21 +975,24 @@ async def unlink_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
     parts = update.message.text.split(maxsplit=1)
     if len(parts) < 2:
         return await update.message.reply_text("Usage: /unlink_user <tokens>")
-    tokens = [t for t in re.split(r"[,\\s]+", parts[1]) if t]
+    tokens = list(dict.fromkeys(t for t in _TOKEN_SPLIT_RE.split(parts[1]) if t))
 
-    cleared = 0
-    with closing(db_connect()) as conn:
-        cur = conn.cursor()
-        for t in tokens:
-            if t.isdigit():
-                tid = int(t)
-                cur.execute("UPDATE users SET personnel_id=NULL, verified_at=NULL, completed_year=NULL, completed_at=NULL WHERE telegram_id=?", (tid,))
-                cleared += cur.rowcount
-        for t in tokens:
-            if not t.isdigit():
-                cur.execute("UPDATE users SET personnel_id=NULL, verified_at=NULL, completed_year=NULL, completed_at=NULL WHERE personnel_id=?", (t,))
-                cleared += cur.rowcount
-        conn.commit()
+    if not tokens:
+        return await update.message.reply_text("No IDs provided.")
+
+    # One UPDATE matching numeric tokens as Telegram IDs and the rest as personnel IDs.
+    by_tid = [int(t) for t in tokens if t.isdigit()]
+    by_pid = [t for t in tokens if not t.isdigit()]
+    where = " OR ".join(
+        clause for clause, ids in (
+            (f"telegram_id IN ({_placeholders(by_tid)})", by_tid),
+            (f"personnel_id IN ({_placeholders(by_pid)})", by_pid),
+        ) if ids
+    )
+    cleared, = await asyncio.to_thread(run_batch, [(
+        f"UPDATE users SET personnel_id=NULL, verified_at=NULL, completed_year=NULL, completed_at=NULL WHERE {where}",
+        [tuple(by_tid + by_pid)],
+    )])
 
     await update.message.reply_text(f"Unlinked {cleared} mapping(s).")
 
@@ -904,18 +1002,20 @@ async def remove_personnel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     parts = update.message.text.split(maxsplit=1)
     if len(parts) < 2:
         return await update.message.reply_text("Usage: /remove_personnel <ID[,ID,...]>")
-    tokens = [t.strip() for t in re.split(r"[,\s]+", parts[1]) if t.strip()]
+    tokens = list(dict.fromkeys(t.strip() for t in _TOKEN_SPLIT_RE.split(parts[1]) if t.strip()))
 
-    removed = 0
-    with closing(db_connect()) as conn:
-        cur = conn.cursor()
-        for pid in tokens:
-            cur.execute("UPDATE users SET personnel_id=NULL, verified_at=NULL, completed_year=NULL, completed_at=NULL WHERE personnel_id=?", (pid,))
-            cur.execute("DELETE FROM deferments WHERE personnel_id=?", (pid,))
-            cur.execute("DELETE FROM cycle_notes WHERE personnel_id=?", (pid,))
-            cur.execute("DELETE FROM personnel WHERE personnel_id=?", (pid,))
-            removed += cur.rowcount
-        conn.commit()
+    if not tokens:
+        return await update.message.reply_text("No IDs provided.")
+
+    # Set-based: each statement runs once over the whole ID list.
+    marks = _placeholders(tokens)
+    params = [tuple(tokens)]
+    *_, removed = await asyncio.to_thread(run_batch, [
+        (f"UPDATE users SET personnel_id=NULL, verified_at=NULL, completed_year=NULL, completed_at=NULL WHERE personnel_id IN ({marks})", params),
+        (f"DELETE FROM deferments WHERE personnel_id IN ({marks})", params),
+        (f"DELETE FROM cycle_notes WHERE personnel_id IN ({marks})", params),
+        (f"DELETE FROM personnel WHERE personnel_id IN ({marks})", params),
+    ])
 
     await update.message.reply_text(f"Removed {removed} personnel record(s).")
 
@@ -923,51 +1023,79 @@ async def remove_personnel(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def report(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not is_admin(update.message.from_user.id):
         return await update.message.reply_text("Admins only.")
-    from openpyxl import Workbook
-    from openpyxl.styles import Font, PatternFill
-    from openpyxl.utils import get_column_letter
-
-    today = current_local_date()
-
-    with closing(db_connect()) as conn:
-        cur = conn.cursor()
-        cur.execute("""
-            SELECT p.personnel_id, p.birthday, p.group_name,
-                   u.telegram_id, u.completed_year, u.completed_at, u.full_name
-              FROM personnel p
-              LEFT JOIN users u ON p.personnel_id = u.personnel_id
-        """)
-        rows = cur.fetchall()
-
-    RED_FILL    = PatternFill(start_color="FFFFC0C0", end_color="FFFFC0C0", fill_type="solid")
-    YELLOW_FILL = PatternFill(start_color="FFFFFF99", end_color="FFFFFF99", fill_type="solid")
+    # Queries + workbook building run on a worker thread so other updates keep flowing.
+    path = await asyncio.to_thread(_build_report_xlsx, current_local_date())
+    try:
+        with open(path, "rb") as f:
+            await update.message.reply_document(document=InputFile(f, filename="ippt_100day_report.xlsx"),
+                                                caption="Report: All + per-group + Cycles_19_40 (Name included)")
+    finally:
+        os.unlink(path)
+
+# Shared report styles: every highlighted row and header cell reuses the same objects.
+RED_FILL    = PatternFill(start_color="FFFFC0C0", end_color="FFFFC0C0", fill_type="solid")
+YELLOW_FILL = PatternFill(start_color="FFFFFF99", end_color="FFFFFF99", fill_type="solid")
+BOLD        = Font(bold=True)
+
+REPORT_HEADERS = [
+    "personnel_id","name","birthday","group_name","verified",
+    "window_start","window_end",
+    "completed_this_window","completed_at",
+    "deferment_status","deferment_reason",
+    "days_left","days_overdue",
+    "cycle_status","cycle_overdue_days"
+]
+REPORT_ROW = itemgetter(*REPORT_HEADERS)
+
+CYCLE_HEADERS = [
+    "personnel_id","name","group_name","age","cycle_start","cycle_end",
+    "window_end","verified","status","overdue_days","completed_at","note"
+]
+
+def _safe_sheet_name(name: str) -> str:
+    bad = ["\\", "/", "?", "*", "[", "]"]
+    for b in bad:
+        name = name.replace(b, " ")
+    name = name.strip() or "No Group"
+    return name[:31]
+
+def _report_rows(rows, today: date, compl):
+    """One record per personnel row of the main report query, for the All and per-group sheets."""
+    # With today fixed, window/cycle maths depends only on the birthday's "MM-DD".
+    windows = {}
+
+    def windows_for(bday_str):
+        md = bday_str[5:10]
+        w = windows.get(md)
+        if w is None:
+            bday = parse_db_date(bday_str)
+            _, start, end = today_in_window(bday, today)
+            cyc_start, cyc_end_excl = cycle_for_date(bday, today)
+            w = windows[md] = (
+                start, end, format_date(start), format_date(end), (end - today).days,
+                cyc_start, cyc_start + timedelta(days=WINDOW_DAYS),
+                iso_from_local_date(cyc_start, 0, 0), iso_from_local_date(cyc_end_excl - timedelta(days=1), 23, 59),
+            )
+        return w
 
-    def build_current_row(pid, bday_str, group_name, telegram_id, completed_year, completed_at, full_name):
-        bday = parse_date_strict(bday_str)
-        _, start, end = today_in_window(bday, today)
+    def build_current_row(pid, bday_str, group_name, telegram_id, completed_year, completed_at, full_name,
+                          cur_reason, cur_status, prev_reason, prev_status, cur_note, prev_note):
+        (start, end, start_str, end_str, days_to_end,
+         cyc_start, cyc_win_end, cyc_from_iso, cyc_to_iso) = windows_for(bday_str)
         window_key = start.year
         done = (completed_year == window_key)
         verified = bool(telegram_id)
 
-        with closing(db_connect()) as conn2:
-            d = get_deferment_by_pid(conn2, pid, window_key)
-        d_status = (d[1] if d else "")
-        d_reason = (d[0] if d else "")
-
-        cyc_start, cyc_end_excl = cycle_for_date(bday, today)
-        cyc_win_end = cyc_start + timedelta(days=WINDOW_DAYS)
+        if window_key == today.year:
+            d_reason, d_status = cur_reason, cur_status
+        else:
+            d_reason, d_status = prev_reason, prev_status
 
         completed_at_str = None
         if telegram_id:
-            with closing(db_connect()) as conn2:
-                c2 = conn2.cursor()
-                c2.execute(
-                    "SELECT completed_at FROM completions WHERE telegram_id=? AND completed_at >= ? AND completed_at < ? ORDER BY completed_at DESC LIMIT 1",
-                    (telegram_id, iso_from_local_date(cyc_start, 0, 0), iso_from_local_date(cyc_end_excl - timedelta(days=1), 23, 59)),
-                )
-                r = c2.fetchone()
-                if r:
-                    completed_at_str = r[0]
+            for _, iso in compl.get(int(telegram_id), ()):
+                if cyc_from_iso <= iso < cyc_to_iso and (completed_at_str is None or iso > completed_at_str):
+                    completed_at_str = iso
 
         cycle_status = "not_completed"
         cycle_overdue_days = ""
@@ -979,23 +1107,20 @@ async def report(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 cycle_status = "overdue"
                 cycle_overdue_days = (cd - cyc_win_end).days
         else:
-            with closing(db_connect()) as conn2:
-                c2 = conn2.cursor()
-                c2.execute("SELECT reason FROM cycle_notes WHERE personnel_id=? AND year=?", (pid, cyc_start.year))
-                note = c2.fetchone()
-            if note and note[0]:
-                cycle_status = f"not_completed ({note[0]})"
+            note = cur_note if cyc_start.year == today.year else prev_note
+            if note:
+                cycle_status = f"not_completed ({note})"
 
         if done:
             days_left, days_overdue = "", ""
         else:
-            if today <= end:
-                days_left, days_overdue = (end - today).days, ""
+            if days_to_end >= 0:
+                days_left, days_overdue = days_to_end, ""
             else:
-                days_left, days_overdue = "", (today - end).days
+                days_left, days_overdue = "", -days_to_end
 
-        highlight_red = (d_status != "approved") and (not done) and (today > end)
-        highlight_yellow = (d_status != "approved") and (not done) and (start <= today <= end) and ((end - today).days < 100)
+        highlight_red = (d_status != "approved") and (not done) and (days_to_end < 0)
+        highlight_yellow = (d_status != "approved") and (not done) and (start <= today) and (0 <= days_to_end < 100)
 
         return {
             "personnel_id": pid,
@@ -1003,8 +1128,8 @@ async def report(update: Update, context: ContextTypes.DEFAULT_TYPE):
             "birthday": bday_str,
             "group_name": group_name or "",
             "verified": "yes" if verified else "no",
-            "window_start": format_date(start),
-            "window_end": format_date(end),
+            "window_start": start_str,
+            "window_end": end_str,
             "completed_this_window": "yes" if done else "no",
             "completed_at": completed_at or "",
             "deferment_status": d_status or "",
@@ -1017,101 +1142,22 @@ async def report(update: Update, context: ContextTypes.DEFAULT_TYPE):
             "_highlight_yellow": highlight_yellow,
         }
 
-    data_rows = [build_current_row(*r) for r in rows]
-
-    headers_all = [
-        "personnel_id","name","birthday","group_name","verified",
-        "window_start","window_end",
-        "completed_this_window","completed_at",
-        "deferment_status","deferment_reason",
-        "days_left","days_overdue",
-        "cycle_status","cycle_overdue_days"
-    ]
-
-    wb = Workbook()
-    ws_all = wb.active
-    ws_all.title = "All"
-    ws_all.append(headers_all)
-    for c in ws_all[1]:
-        c.font = Font(bold=True)
-
-    def write_row(ws, rec):
-        ws.append([rec[h] for h in headers_all])
-        fill = None
-        if rec.get("_highlight_red"):
-            fill = RED_FILL
-        elif rec.get("_highlight_yellow"):
-            fill = YELLOW_FILL
-        if fill:
-            for cell in ws[ws.max_row]:
-                cell.fill = fill
-
-    for rec in data_rows:
-        write_row(ws_all, rec)
-
-    for col_idx in range(1, ws_all.max_column + 1):
-        col_letter = get_column_letter(col_idx)
-        max_len = 12
-        for row in range(1, ws_all.max_row + 1):
-            val = ws_all.cell(row=row, column=col_idx).value
-            max_len = max(max_len, len(str(val)) if val is not None else 0)
-        ws_all.column_dimensions[col_letter].width = min(40, max_len + 2)
-
-    # Per-group sheets
-    groups = {}
-    for rec in data_rows:
-        key = (rec["group_name"] or "No Group")
-        groups.setdefault(key, []).append(rec)
-
-    def safe_sheet_name(name: str) -> str:
-        bad = ["\\", "/", "?", "*", "[", "]"]
-        for b in bad:
-            name = name.replace(b, " ")
-        name = name.strip() or "No Group"
-        return name[:31]
-
-    for gname, recs in sorted(groups.items(), key=lambda kv: kv[0].lower()):
-        ws = wb.create_sheet(title=safe_sheet_name(gname))
-        ws.append(headers_all)
-        for c in ws[1]:
-            c.font = Font(bold=True)
-        for rec in recs:
-            write_row(ws, rec)
-        for col_idx in range(1, ws.max_column + 1):
-            col_letter = get_column_letter(col_idx)
-            max_len = 12
-            for row in range(1, ws.max_row + 1):
-                val = ws.cell(row=row, column=col_idx).value
-                max_len = max(max_len, len(str(val)) if val is not None else 0)
-            ws.column_dimensions[col_letter].width = min(40, max_len + 2)
-
-    # Cycles 19–40
-    ws_cyc = wb.create_sheet(title="Cycles_19_40")
-    headers_cyc = [
-        "personnel_id","name","group_name","age","cycle_start","cycle_end",
-        "window_end","verified","status","overdue_days","completed_at","note"
-    ]
-    ws_cyc.append(headers_cyc)
-    for c in ws_cyc[1]:
-        c.font = Font(bold=True)
-
-    with closing(db_connect()) as conn:
-        cur = conn.cursor()
-        cur.execute("SELECT telegram_id, completed_at FROM completions")
-        compl = {}
-        for tid, iso in cur.fetchall():
-            if tid is None or not iso:
-                continue
-            compl.setdefault(int(tid), []).append((datetime.fromisoformat(iso).date(), iso))
-
-    with closing(db_connect()) as conn:
-        cur = conn.cursor()
-        cur.execute("SELECT p.personnel_id, p.birthday, p.group_name, u.telegram_id, u.full_name FROM personnel p LEFT JOIN users u ON p.personnel_id=u.personnel_id")
-        pers = cur.fetchall()
+    return [build_current_row(*r) for r in rows]
 
+def _cycle_rows(pers, compl, notes):
+    """Age 19-40 cycle rows per personnel from (pid, birthday, group, telegram_id, name) tuples."""
+    cyc_rows = []
     for pid, bday_str, group_name, telegram_id, full_name in pers:
-        bday = parse_date_strict(bday_str)
+        bday = parse_db_date(bday_str)
         birth_year = bday.year
+        # Latest completion per cycle start year, so each age below is a dict lookup, not a history scan.
+        best_by_year = {}
+        if telegram_id:
+            for d, iso in compl.get(int(telegram_id), ()):
+                y = cycle_for_date(bday, d)[0].year
+                best = best_by_year.get(y)
+                if best is None or d > best[0]:
+                    best_by_year[y] = (d, iso)
         for age in range(19, 41):
             cyc_start = adjusted_birthday_for_year(bday, birth_year + age)
             cyc_end_excl = adjusted_birthday_for_year(bday, birth_year + age + 1)
@@ -1122,121 +1168,274 @@ async def report(update: Update, context: ContextTypes.DEFAULT_TYPE):
             completed_at_out = ""
             note = ""
 
-            if telegram_id and int(telegram_id) in compl:
-                best = None
-                for d, iso in compl[int(telegram_id)]:
-                    if cyc_start <= d < cyc_end_excl:
-                        if best is None or d > best[0]:
-                            best = (d, iso)
-                if best:
-                    completed_at_out = best[0].strftime("%Y-%m-%d")
-                    if best[0] <= window_end:
-                        status = "on_time"
-                    else:
-                        status = "overdue"
-                        overdue_days = (best[0] - window_end).days
+            best = best_by_year.get(cyc_start.year)
+            if best:
+                completed_at_out = best[0].strftime("%Y-%m-%d")
+                if best[0] <= window_end:
+                    status = "on_time"
+                else:
+                    status = "overdue"
+                    overdue_days = (best[0] - window_end).days
             if status == "not_completed":
-                with closing(db_connect()) as conn2:
-                    c2 = conn2.cursor()
-                    c2.execute("SELECT reason FROM cycle_notes WHERE personnel_id=? AND year=?", (pid, cyc_start.year))
-                    r = c2.fetchone()
-                    if r and r[0]:
-                        note = r[0]
-
-            ws_cyc.append([
+                note = notes.get((pid, cyc_start.year)) or ""
+
+            cyc_rows.append([
                 pid, (full_name or ""), (group_name or ""), age,
                 format_date(cyc_start), format_date(cyc_end_excl - timedelta(days=1)),
                 format_date(window_end),
                 "yes" if telegram_id else "no",
                 status, overdue_days, completed_at_out, note
             ])
+    return cyc_rows
+
+def _build_report_xlsx(today: date) -> str:
+    """Write the report to a temp .xlsx and return its path; the caller deletes it."""
+    conn = read_db()
+    cur = conn.cursor()
+    # Window key and cycle year are always this year or last year; join both candidates.
+    cur.execute("""
+        SELECT p.personnel_id, p.birthday, p.group_name,
+               u.telegram_id, u.completed_year, u.completed_at, u.full_name,
+               dc.reason, dc.status, dp.reason, dp.status, nc.reason, np.reason
+          FROM personnel p
+          LEFT JOIN users u ON p.personnel_id = u.personnel_id
+          LEFT JOIN deferments dc ON dc.personnel_id = p.personnel_id AND dc.year = ?1
+          LEFT JOIN deferments dp ON dp.personnel_id = p.personnel_id AND dp.year = ?2
+          LEFT JOIN cycle_notes nc ON nc.personnel_id = p.personnel_id AND nc.year = ?1
+          LEFT JOIN cycle_notes np ON np.personnel_id = p.personnel_id AND np.year = ?2
+    """, (today.year, today.year - 1))
+    rows = cur.fetchall()
+
+    # Completion history and cycle notes are read once up front; the row builders look them up in memory.
+    cur.execute("SELECT telegram_id, completed_at FROM completions")
+    compl = {}
+    for tid, iso in cur.fetchall():
+        if tid is None or not iso:
+            continue
+        compl.setdefault(int(tid), []).append((datetime.fromisoformat(iso).date(), iso))
+    cur.execute("SELECT personnel_id, year, reason FROM cycle_notes")
+    notes = {(pid, yr): reason for pid, yr, reason in cur.fetchall()}
+
+    data_rows = _report_rows(rows, today, compl)
+
+    # Write-only mode: column widths go out with the sheet header, so they are computed before the first append.
+    wb = Workbook(write_only=True)
+
+    def track_widths(widths, values):
+        for i, v in enumerate(values):
+            n = len(str(v)) if v is not None else 0
+            if n > widths[i]:
+                widths[i] = n
+
+    def styled(ws, values, font=None, fill=None):
+        cells = []
+        for v in values:
+            c = WriteOnlyCell(ws, value=v)
+            if font:
+                c.font = font
+            if fill:
+                c.fill = fill
+            cells.append(c)
+        return cells
+
+    def write_sheet(ws, headers, rows_values, fills, cap):
+        widths = [len(h) for h in headers]
+        for values in rows_values:
+            track_widths(widths, values)
+        for i, w in enumerate(widths, start=1):
+            ws.column_dimensions[get_column_letter(i)].width = min(cap, max(12, w) + 2)
+        ws.append(styled(ws, headers, font=BOLD))
+        for values, fill in zip(rows_values, fills):
+            ws.append(styled(ws, values, fill=fill) if fill else values)
+
+    def row_fill(rec):
+        if rec.get("_highlight_red"):
+            return RED_FILL
+        if rec.get("_highlight_yellow"):
+            return YELLOW_FILL
+        return None
 
-    for col_idx in range(1, ws_cyc.max_column + 1):
-        col_letter = get_column_letter(col_idx)
-        max_len = 12
-        for row in range(1, ws_cyc.max_row + 1):
-            val = ws_cyc.cell(row=row, column=col_idx).value
-            max_len = max(max_len, len(str(val)) if val is not None else 0)
-        ws_cyc.column_dimensions[col_letter].width = min(50, max_len + 2)
+    def write_records(ws, recs):
+        write_sheet(ws, REPORT_HEADERS, [REPORT_ROW(rec) for rec in recs], [row_fill(rec) for rec in recs], 40)
 
-    out = io.BytesIO()
-    wb.save(out); out.seek(0)
-    await update.message.reply_document(document=InputFile(out, filename="ippt_100day_report.xlsx"),
-                                        caption="Report: All + per-group + Cycles_19_40 (Name included)")
+    write_records(wb.create_sheet(title="All"), data_rows)
+
+    # Per-group sheets
+    groups = {}
+    for rec in data_rows:
+        key = (rec["group_name"] or "No Group")
+        groups.setdefault(key, []).append(rec)
+
+    for gname, recs in sorted(groups.items(), key=lambda kv: kv[0].lower()):
+        write_records(wb.create_sheet(title=_safe_sheet_name(gname)), recs)
+
+    # Cycles 19–40
+    cur.execute("SELECT p.personnel_id, p.birthday, p.group_name, u.telegram_id, u.full_name FROM personnel p LEFT JOIN users u ON p.personnel_id=u.personnel_id")
+    cyc_rows = _cycle_rows(cur.fetchall(), compl, notes)
+    write_sheet(wb.create_sheet(title="Cycles_19_40"), CYCLE_HEADERS, cyc_rows, [None] * len(cyc_rows), 50)
+
+    # The write-only workbook streams into the file, so no in-memory copy is built here.
+    with tempfile.NamedTemporaryFile(suffix=".xlsx", delete=False) as tmp:
+        try:
+            wb.save(tmp)
+        except Exception:
+            tmp.close()
+            os.unlink(tmp.name)
+            raise
+    return tmp.name
 
 # ---------- Audit ----------
 async def defer_audit(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not is_admin(update.message.from_user.id):
         return await update.message.reply_text("Admins only.")
-    out = io.StringIO()
-    writer = csv.writer(out)
-    writer.writerow(["personnel_id","year","reason","status","created_at"])
-    with closing(db_connect()) as conn:
-        cur = conn.cursor()
-        cur.execute("SELECT personnel_id, year, reason, status, created_at FROM deferments ORDER BY year, personnel_id")
-        for pid, yr, reason, status, created_at in cur.fetchall():
-            writer.writerow([pid, yr, reason or "", status or "", created_at or ""])
-    data = out.getvalue().encode("utf-8")
-    bio = io.BytesIO(data); bio.seek(0)
+    bio = await asyncio.to_thread(_build_defer_audit_csv)
     await update.message.reply_document(document=InputFile(bio, filename="deferment_audit.csv"),
                                         caption="Deferment audit CSV")
 
+def _build_defer_audit_csv() -> io.BytesIO:
+    # csv writes straight through a UTF-8 encoder into the upload buffer: no intermediate str copy.
+    bio = io.BytesIO()
+    out = io.TextIOWrapper(bio, encoding="utf-8", newline="", write_through=True)
+    writer = csv.writer(out)
+    writer.writerow(["personnel_id","year","reason","status","created_at"])
+    cur = read_db().cursor()
+    cur.execute("SELECT personnel_id, year, reason, status, created_at FROM deferments ORDER BY year, personnel_id")
+    writer.writerows((pid, yr, reason or "", status or "", created_at or "") for pid, yr, reason, status, created_at in cur)
+    out.detach()
+    bio.seek(0)
+    return bio
+
 # ---------- Scheduler ----------
+class TokenBucket:
+    """Async rate gate: at most `rate` acquisitions per `per` seconds, refilled continuously."""
+    def __init__(self, rate: int, per: float = 1.0):
+        self.rate = rate
+        self.per = per
+        self.tokens = float(rate)
+        self.updated = monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self.lock:
+            while True:
+                now = monotonic()
+                self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate / self.per)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) * self.per / self.rate)
+
+# Telegram allows ~30 messages/s across all chats.
+SEND_BUCKET = TokenBucket(30, 1.0)
+_SEND_SEM = asyncio.Semaphore(25)
+
+async def safe_send(bot, chat_id, text, **kw):
+    """send_message through the global rate gate, retrying once on flood control."""
+    await SEND_BUCKET.acquire()
+    try:
+        return await bot.send_message(chat_id=chat_id, text=text, **kw)
+    except RetryAfter as e:
+        await asyncio.sleep(e.retry_after)
+        await SEND_BUCKET.acquire()
+        return await bot.send_message(chat_id=chat_id, text=text, **kw)
+
+REMINDER_TEXT = (
+    "Reminder: Your IPPT window is {start} → {end}.\n"
+    "Use /complete when done. You can also do /status anytime."
+)
+
 async def daily_reminder_job(context: ContextTypes.DEFAULT_TYPE):
     today = current_local_date()
-    with closing(db_connect()) as conn:
-        cur = conn.cursor()
-        cur.execute("""
-            SELECT u.telegram_id, u.personnel_id, p.birthday, u.completed_year
-              FROM users u
-              JOIN personnel p ON u.personnel_id = p.personnel_id
-        """)
-        rows = cur.fetchall()
-
-    for telegram_id, pid, bday_str, completed_year in rows:
-        bday = parse_date_strict(bday_str)
-        in_window, start, end = today_in_window(bday, today)
+    conn = read_db()
+    cur = conn.cursor()
+    # The window key is this year or last year; fetch both deferment statuses in the same pass.
+    cur.execute("""
+        SELECT u.telegram_id, u.personnel_id, p.birthday, u.completed_year, dc.status, dp.status
+          FROM users u
+          JOIN personnel p ON u.personnel_id = p.personnel_id
+          LEFT JOIN deferments dc ON dc.personnel_id = u.personnel_id AND dc.year = ?
+          LEFT JOIN deferments dp ON dp.personnel_id = u.personnel_id AND dp.year = ?
+    """, (today.year, today.year - 1))
+    rows = cur.fetchall()
+
+    expired_defer, expired_done, due = [], [], []
+    # With today fixed the window depends only on the birthday's "MM-DD", so resolve it once per key.
+    windows = {}
+    for telegram_id, pid, bday_str, completed_year, cur_status, prev_status in rows:
+        md = bday_str[5:10]
+        w = windows.get(md)
+        if w is None:
+            w = windows[md] = today_in_window(parse_db_date(bday_str), today)
+        in_window, start, end = w
         window_key = start.year
 
-        with closing(db_connect()) as conn:
-            d = get_deferment_by_pid(conn, pid, window_key)
-        skip = bool(d and d[1] == "approved")
+        skip = (cur_status if window_key == today.year else prev_status) == "approved"
         done = (completed_year == window_key)
 
         # end-of-window maintenance
         if today > end:
-            try:
-                with closing(db_connect()) as conn2:
-                    c2 = conn2.cursor()
-                    c2.execute("DELETE FROM deferments WHERE personnel_id=? AND year=?", (pid, window_key))
-                    conn2.commit()
-            except Exception:
-                pass
-            try:
-                with closing(db_connect()) as conn3:
-                    c3 = conn3.cursor()
-                    c3.execute("UPDATE users SET completed_year=NULL, completed_at=NULL WHERE telegram_id=? AND completed_year=?", (telegram_id, window_key))
-                    conn3.commit()
-            except Exception:
-                pass
+            expired_defer.append((pid, window_key))
+            expired_done.append((telegram_id, window_key))
 
         if in_window and not done and not skip:
             days_since_start = (today - start).days
             if days_since_start % REMINDER_INTERVAL_DAYS == 0:
-                try:
-                    await context.bot.send_message(
-                        chat_id=telegram_id,
-                        text=(
-                            f"Reminder: Your IPPT window is {format_date(start)} → {format_date(end)}.\n"
-                            f"Use /complete when done. You can also do /status anytime."
-                        ),
-                    )
-                except Exception:
-                    pass
+                due.append((telegram_id, start, end))
+
+    # All maintenance for the sweep goes out as one transaction, off the event loop.
+    if expired_defer:
+        try:
+            await asyncio.to_thread(run_batch, [
+                ("DELETE FROM deferments WHERE personnel_id=? AND year=?", expired_defer),
+                ("UPDATE users SET completed_year=NULL, completed_at=NULL WHERE telegram_id=? AND completed_year=?", expired_done),
+            ])
+        except Exception:
+            pass
+
+    # Users sharing a birthday share a window, so render each distinct text once.
+    texts = {}
+    sends = []
+    for telegram_id, start, end in due:
+        text = texts.get(start)
+        if text is None:
+            text = texts[start] = REMINDER_TEXT.format(start=format_date(start), end=format_date(end))
+        sends.append(_send_limited(context.bot, telegram_id, text))
+    await asyncio.gather(*sends, return_exceptions=True)
+
+async def _send_limited(bot, chat_id, text):
+    # Bounded fan-out; SEND_BUCKET smooths the actual send rate.
+    async with _SEND_SEM:
+        try:
+            await safe_send(bot, chat_id, text)
+        except Exception:
+            pass
+
+def _wal_checkpoint():
+    with _DB_LOCK:
+        get_db().execute("PRAGMA wal_checkpoint(PASSIVE)")
+
+async def wal_checkpoint_job(context: ContextTypes.DEFAULT_TYPE):
+    # Fold the WAL back into the main DB on a worker thread, off the command path.
+    try:
+        await asyncio.to_thread(_wal_checkpoint)
+    except Exception as e:
+        logger.warning("WAL checkpoint failed: %s", e)
+
+def _optimize():
+    with _DB_LOCK:
+        get_db().execute("PRAGMA optimize")
+
+async def optimize_job(context: ContextTypes.DEFAULT_TYPE):
+    # Refresh planner statistics as completions/deferments grow; may run ANALYZE, so keep it off the loop.
+    try:
+        await asyncio.to_thread(_optimize)
+    except Exception as e:
+        logger.warning("PRAGMA optimize failed: %s", e)
 
 # Manual trigger for testing
 async def remind_now(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if update.message.from_user.id not in ADMIN_IDS:
+    if not is_admin(update.message.from_user.id):
         return await update.message.reply_text("Admins only.")
     await daily_reminder_job(context)
     await update.message.reply_text("✅ Reminders triggered now.")
@@ -1277,16 +1476,30 @@ def schedule_jobs(app):
         app.job_queue.run_repeating(daily_reminder_job, interval=60, first=1, name="test_reminders")
     else:
         app.job_queue.run_daily(daily_reminder_job, time=time(hour=9, minute=0, tzinfo=TZINFO), name="daily_reminders")
+    app.job_queue.run_repeating(wal_checkpoint_job, interval=300, first=300, name="wal_checkpoint")
+    app.job_queue.run_repeating(optimize_job, interval=7 * 24 * 3600, first=7 * 24 * 3600, name="db_optimize")
 
 def main():
     init_db()
     if not BOT_TOKEN:
         raise SystemExit("Missing BOT_TOKEN env var.")
-    app = ApplicationBuilder().token(BOT_TOKEN).build()
+    # Handlers run as independent tasks so a slow report/import never holds up other users' updates.
+    app = ApplicationBuilder().token(BOT_TOKEN).concurrent_updates(True).build()
     setup_handlers(app)
     schedule_jobs(app)
-    print("Bot is running…")
-    app.run_polling(close_loop=False)
+    if WEBHOOK_URL:
+        print(f"Bot is running (webhook on :{PORT})…")
+        app.run_webhook(
+            listen="0.0.0.0",
+            port=PORT,
+            url_path=WEBHOOK_SECRET,
+            webhook_url=f"{WEBHOOK_URL}/{WEBHOOK_SECRET}",
+            secret_token=WEBHOOK_SECRET,
+            close_loop=False,
+        )
+    else:
+        print("Bot is running…")
+        app.run_polling(close_loop=False)
 
 if __name__ == "__main__":
     main()
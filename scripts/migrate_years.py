@@ -77,7 +77,7 @@ def main():
           JOIN personnel p ON p.personnel_id = u.personnel_id
         """    )
     comp_rows = cur.fetchall()
-    comp_updates = 0
+    comp_updates = []
     for cid, tid, year, completed_at, bday_str in comp_rows:
         try:
             completed_on = datetime.fromisoformat(completed_at).date()
@@ -87,11 +87,9 @@ def main():
         bday = parse_date_strict(bday_str)
         new_year = window_for_completion(bday, completed_on)
         if new_year != year:
-            comp_updates += 1
+            comp_updates.append((new_year, cid))
             if args.verbose or not args.apply:
                 print(f"[completions] id={cid} telegram_id={tid} {year} -> {new_year} (completed_at={completed_at}, bday={bday_str})")
-            if args.apply:
-                cur.execute("UPDATE completions SET year=? WHERE id=?", (new_year, cid))
 
     # 2) Fix users.completed_year (based on users.completed_at when present)
     cur.execute(        """        SELECT u.telegram_id, u.completed_year, u.completed_at, p.birthday
@@ -100,7 +98,7 @@ def main():
          WHERE u.completed_year IS NOT NULL
         """    )
     user_rows = cur.fetchall()
-    user_updates = 0
+    user_updates = []
     for tid, uyear, ucompleted_at, bday_str in user_rows:
         if not ucompleted_at:
             continue
@@ -111,18 +109,19 @@ def main():
         bday = parse_date_strict(bday_str)
         new_year = window_for_completion(bday, completed_on)
         if new_year != uyear:
-            user_updates += 1
+            user_updates.append((new_year, tid))
             if args.verbose or not args.apply:
                 print(f"[users] telegram_id={tid} {uyear} -> {new_year} (completed_at={ucompleted_at}, bday={bday_str})")
-            if args.apply:
-                cur.execute("UPDATE users SET completed_year=? WHERE telegram_id=?", (new_year, tid))
 
     if args.apply:
-        conn.commit()
+        # One prepared statement per table, one transaction for the whole migration.
+        with conn:
+            cur.executemany("UPDATE completions SET year=? WHERE id=?", comp_updates)
+            cur.executemany("UPDATE users SET completed_year=? WHERE telegram_id=?", user_updates)
 
     print("\nSummary:")
-    print(f"  completions rows needing update: {comp_updates}")
-    print(f"  users rows needing update:       {user_updates}")
+    print(f"  completions rows needing update: {len(comp_updates)}")
+    print(f"  users rows needing update:       {len(user_updates)}")
     print(f"  mode: {'APPLY' if args.apply else 'DRY-RUN'}")
 
 if __name__ == "__main__":